@@ -5,7 +5,7 @@
 # FastAPI provides high performance through asynchronous processing and automatically generates API documentation (Swagger UI).
 #
 # --- How to run ---
-# 1. Install Python 3.8+
+# 1. Install Python 3.9+
 # 2. Create and activate virtual environment:
 #    uv venv
 #    uv venv --python 3.12
@@ -22,15 +22,31 @@
 #    JWT_SECRET=your_super_secret_key_for_jwt
 #    ALGORITHM=HS256
 #    ACCESS_TOKEN_EXPIRE_MINUTES=30
+#    # Optional DB pool tuning (per uvicorn worker process)
+#    DB_POOL_MIN_SIZE=5
+#    DB_POOL_MAX_SIZE=25
+#    DB_POOL_MAX_INACTIVE_LIFETIME=300
+#    DB_STATEMENT_CACHE_SIZE=1024   # set 0 behind PgBouncer in transaction pooling mode
+#    DB_POOL_ACQUIRE_TIMEOUT=10     # seconds any endpoint waits for a pooled connection before 503
 # 5. Run uvicorn server in terminal:
 #    uvicorn main:app --reload  (if main.py is saved)
 # 6. Access http://127.0.0.1:8000/docs to view API documentation and test.
 #
+#    For production, run one worker process per core, e.g.
+#    uvicorn main:app --host 0.0.0.0 --workers $(nproc)   (or set WEB_CONCURRENCY)
+#    Each process has its own DB pool and auth cache, so the effective pool is
+#    workers * DB_POOL_MAX_SIZE; keep postgresql.conf max_connections above that
+#    (plus the reminder worker). For very high concurrency, put PgBouncer in front.
+#
 # main.py
+import anyio
+import asyncio
+import contextlib
 import os
 from dotenv import load_dotenv
 import asyncpg
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Request, status
+from fastapi.exception_handlers import http_exception_handler
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr, Field, ConfigDict
 from typing import List, Optional
@@ -38,7 +54,12 @@ import jwt
 from passlib.context import CryptContext
 from datetime import datetime, timedelta, timezone
 from fastapi.middleware.cors import CORSMiddleware
-import json
+from fastapi.responses import StreamingResponse
+from cachetools import TTLCache
+import hashlib
+import itertools
+import orjson
+import time
 
 # --- 1. Setup and initialization ---
 load_dotenv()
@@ -57,8 +78,15 @@ DATABASE_URL = (
 JWT_SECRET = _require_env('JWT_SECRET')
 ALGORITHM = os.getenv('ALGORITHM', 'HS256')
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv('ACCESS_TOKEN_EXPIRE_MINUTES', '30'))
-
-# Create FastAPI app instance
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '5'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '25'))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_POOL_MAX_INACTIVE_LIFETIME', '300'))
+# Server-side prepared statements don't survive PgBouncer transaction pooling; use 0 there
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '1024'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+
+# Create FastAPI app instance. Keep the default response class: response_model endpoints
+# then serialize via Pydantic's Rust dump_json, which a custom default would bypass.
 app = FastAPI(title="Slack Shared Todo Reminder API")
 
 # CORS configuration (origins managed via environment variable)
@@ -77,6 +105,11 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # OAuth2 setup
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/token")
 
+# Short-lived cache of validated tokens: blake2b(token) -> (UserInDB, exp)
+# Skips JWT verification and the users lookup on repeated requests.
+AUTH_CACHE_TTL_SECS = int(os.getenv('AUTH_CACHE_TTL_SECS', '30'))
+_auth_cache = TTLCache(maxsize=10000, ttl=AUTH_CACHE_TTL_SECS)
+
 # Database connection pool
 db_pool = None
 
@@ -84,11 +117,33 @@ db_pool = None
 @app.on_event("startup")
 async def startup():
     global db_pool
-    # Create database connection pool when app starts
+    # Create database connection pool when app starts.
+    # search_path travels in the startup packet, so no per-acquire SET is needed.
     async def _init_connection(conn):
-        # Ensure schema resolution for every pooled connection
-        await conn.execute("SET search_path TO todo_app, public")
-    db_pool = await asyncpg.create_pool(DATABASE_URL, init=_init_connection, min_size=1, max_size=10)
+        # JSONB <-> dict via orjson, so payloads need no manual (de)serialization
+        await conn.set_type_codec(
+            'jsonb',
+            encoder=_jsonb_dumps,
+            decoder=orjson.loads,
+            schema='pg_catalog',
+            format='text',
+        )
+    db_pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        init=_init_connection,
+        server_settings={"search_path": "todo_app, public"},
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+    )
+
+# A pool checkout that times out means every connection is busy: answer 503, not 500
+@app.exception_handler(asyncio.TimeoutError)
+async def pool_timeout_handler(request: Request, exc: asyncio.TimeoutError):
+    return await http_exception_handler(
+        request, HTTPException(status_code=503, detail="Database busy, please retry.")
+    )
 
 @app.on_event("shutdown")
 async def shutdown():
@@ -142,13 +197,71 @@ class TodoUpdate(BaseModel):
     payload: Optional[dict] = None
 
 
+# --- SQL statements ---
+# Query text is kept fixed so asyncpg's per-connection statement cache reuses
+# the server-side prepared statement instead of re-parsing on every call.
+# Columns returned for a todo (matches TodoPublic); avoids shipping unused columns
+# todos.completed is nullable; coalesce so rows always match TodoPublic's bool
+TODO_COLUMNS = "id, user_id, description, due_date, payload, COALESCE(completed, FALSE) AS completed, created_at, completed_at"
+
+SQL_SELECT_AUTH_USER = "SELECT id, email, password_hash FROM users WHERE email = $1"
+SQL_SELECT_LOGIN_USER = "SELECT email, password_hash FROM users WHERE email = $1 LIMIT 1"
+SQL_INSERT_USER = """
+    INSERT INTO users (email, password_hash, slack_channel)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (email) DO NOTHING
+    RETURNING id, email, slack_channel, created_at
+"""
+SQL_INSERT_TODO = f"""
+    INSERT INTO todos (user_id, description, due_date, payload)
+    VALUES ($1, $2, $3, $4)
+    RETURNING {TODO_COLUMNS}
+"""
+SQL_SELECT_TODO = f"SELECT {TODO_COLUMNS} FROM todos WHERE id = $1 AND user_id = $2"
+SQL_DELETE_TODO = "DELETE FROM todos WHERE id = $1 AND user_id = $2"
+
+# PATCH statements for every non-empty subset of updatable fields, keyed by
+# frozenset(fields); SET columns follow this canonical order so parameter
+# positions are deterministic. 'completed' also writes 'completed_at'.
+TODO_UPDATE_FIELDS = ("description", "due_date", "completed", "payload")
+
+def _build_update_todo_sql(fields: tuple) -> tuple:
+    columns = [col for f in fields for col in ((f, "completed_at") if f == "completed" else (f,))]
+    set_clauses = ", ".join(f"{col} = ${i + 2}" for i, col in enumerate(columns))
+    query = f"UPDATE todos SET {set_clauses} WHERE id = $1 AND user_id = ${len(columns) + 2} RETURNING {TODO_COLUMNS}"
+    return tuple(columns), query
+
+_UPDATE_TODO_SQL = {
+    frozenset(fields): _build_update_todo_sql(fields)
+    for n in range(1, len(TODO_UPDATE_FIELDS) + 1)
+    for fields in itertools.combinations(TODO_UPDATE_FIELDS, n)
+}
+
+
 # --- 4. Security and authentication utilities ---
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+class _OrjsonJWT(jwt.PyJWT):
+    # PyJWT's documented override point for payload decoding; orjson parses the claims
+    def _decode_payload(self, decoded: dict):
+        try:
+            payload = orjson.loads(decoded["payload"])
+        except ValueError as e:
+            raise jwt.DecodeError(f"Invalid payload string: {e}") from e
+        if not isinstance(payload, dict):
+            raise jwt.DecodeError("Invalid payload string: must be a json object")
+        return payload
+
+_jwt_decoder = _OrjsonJWT()
+# Prepared once instead of on every verify
+_JWT_SECRET_BYTES = JWT_SECRET.encode()
+_JWT_ALGORITHMS = [ALGORITHM]
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+# bcrypt is ~100 ms of CPU; run it in a thread so the event loop keeps serving
+async def verify_password(plain_password, hashed_password):
+    return await asyncio.to_thread(pwd_context.verify, plain_password, hashed_password)
+
+async def get_password_hash(password):
+    return await asyncio.to_thread(pwd_context.hash, password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -160,27 +273,9 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=ALGORITHM)
     return encoded_jwt
 
-# --- Utility: normalize JSONB payload from DB ---
-def _parse_payload_value(value):
-    if value is None:
-        return None
-    if isinstance(value, (dict, list)):
-        return value
-    if isinstance(value, str):
-        text = value.strip()
-        if text == "" or text.lower() == "null":
-            return None
-        try:
-            return json.loads(text)
-        except Exception:
-            return None
-    return value
-
-def _coerce_todo_record(record) -> dict:
-    data = dict(record)
-    if 'payload' in data:
-        data['payload'] = _parse_payload_value(data['payload'])
-    return data
+# --- Utility: JSONB codec encoder (asyncpg's text format expects str) ---
+def _jsonb_dumps(value) -> str:
+    return orjson.dumps(value).decode()
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
@@ -188,23 +283,71 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    cached = _auth_cache.get(cache_key)
+    # Never serve a cached user past the token's own expiry
+    if cached is not None and cached[1] > time.time():
+        return cached[0]
+
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[ALGORITHM])
+        payload = _jwt_decoder.decode(token, _JWT_SECRET_BYTES, algorithms=_JWT_ALGORITHMS)
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
     except jwt.PyJWTError:
         raise credentials_exception
     
-    # Defensive: ensure search_path is correct for acquired connection, too
-    async with db_pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        user_record = await conn.fetchrow("SELECT id, email, password_hash FROM users WHERE email = $1", email)
+    async with db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT) as conn:
+        user_record = await conn.fetchrow(SQL_SELECT_AUTH_USER, email)
     
     if user_record is None:
         raise credentials_exception
     
-    return UserInDB(**dict(user_record))
+    # Trusted DB row: skip EmailStr/int re-validation
+    user = UserInDB.model_construct(**user_record)
+    _auth_cache[cache_key] = (user, payload.get("exp", 0))
+    return user
+
+
+# --- Utility: stream query rows as a JSON array ---
+TODO_STREAM_PAGE_SIZE = 256
+
+async def _close_todo_stream(conn, transaction):
+    # Read-only transaction: rolling back just ends the snapshot and closes the cursor
+    with contextlib.suppress(Exception):
+        await transaction.rollback()
+    await db_pool.release(conn)
+
+async def _stream_todo_records(cursor, page):
+    # The query and first page already ran in the handler, so DB errors surfaced as 5xx.
+    # Remaining pages are fetched as the client reads, so the connection and its
+    # transaction snapshot stay checked out for the whole download.
+    yield b"["
+    first = True
+    while page:
+        body = b",".join(orjson.dumps(dict(record), option=orjson.OPT_UTC_Z) for record in page)
+        yield body if first else b"," + body
+        first = False
+        if len(page) < TODO_STREAM_PAGE_SIZE:
+            break
+        page = await cursor.fetch(TODO_STREAM_PAGE_SIZE)
+    yield b"]"
+
+class _PooledStreamingResponse(StreamingResponse):
+    # Returns the connection to the pool on every path, including when the body is
+    # never iterated (e.g. the client disconnected before the response started)
+    def __init__(self, content, conn, transaction, **kwargs):
+        super().__init__(content, **kwargs)
+        self._conn = conn
+        self._transaction = transaction
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+                await _close_todo_stream(self._conn, self._transaction)
 
 
 # --- 5. API routes (Endpoints) ---
@@ -212,31 +355,25 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
 # === 5.1 Authentication API ===
 @app.post("/api/auth/register", response_model=UserPublic, status_code=status.HTTP_201_CREATED)
 async def register_user(user: UserCreate):
-    async with db_pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        existing_user = await conn.fetchval("SELECT id FROM users WHERE email = $1", user.email)
-        if existing_user:
-            raise HTTPException(status_code=400, detail="Email already registered.")
-        
-        password_hash = get_password_hash(user.password)
-        
+    # Hash before acquiring so bcrypt doesn't hold a pooled connection
+    password_hash = await get_password_hash(user.password)
+
+    # Single roundtrip: the unique email constraint decides, no check-then-insert race
+    async with db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT) as conn:
         new_user_record = await conn.fetchrow(
-            """
-            INSERT INTO users (email, password_hash, slack_channel)
-            VALUES ($1, $2, $3)
-            RETURNING id, email, slack_channel, created_at
-            """,
-            user.email, password_hash, user.slack_channel
+            SQL_INSERT_USER, user.email, password_hash, user.slack_channel
         )
+    if new_user_record is None:
+        raise HTTPException(status_code=400, detail="Email already registered.")
     return UserPublic.model_validate(dict(new_user_record))
 
 @app.post("/api/auth/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    async with db_pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        user_record = await conn.fetchrow("SELECT * FROM users WHERE email = $1", form_data.username)
+    async with db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT) as conn:
+        user_record = await conn.fetchrow(SQL_SELECT_LOGIN_USER, form_data.username)
 
-    if not user_record or not verify_password(form_data.password, user_record['password_hash']):
+    # Connection is already released here, so bcrypt doesn't pin a pool slot
+    if not user_record or not await verify_password(form_data.password, user_record['password_hash']):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Email or password is incorrect.",
@@ -267,7 +404,7 @@ async def root():
 async def healthz():
     # basic DB connectivity check too (non-fatal)
     try:
-        async with db_pool.acquire() as conn:
+        async with db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT) as conn:
             await conn.execute("SELECT 1")
         return {"ok": True, "db": "up"}
     except Exception as e:
@@ -276,17 +413,13 @@ async def healthz():
 # === 5.2 Todos API ===
 @app.post("/api/todos", response_model=TodoPublic, status_code=status.HTTP_201_CREATED)
 async def create_todo(todo: TodoCreate, current_user: UserInDB = Depends(get_current_user)):
-    async with db_pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
+    async with db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT) as conn:
         new_todo_record = await conn.fetchrow(
-            """
-            INSERT INTO todos (user_id, description, due_date, payload)
-            VALUES ($1, $2, $3, $4)
-            RETURNING *
-            """,
-            current_user.id, todo.description, todo.due_date, json.dumps(todo.payload) if todo.payload else None
+            SQL_INSERT_TODO,
+            current_user.id, todo.description, todo.due_date, todo.payload or None
         )
-    return TodoPublic.model_validate(_coerce_todo_record(new_todo_record))
+    # Rows are already typed (datetimes, payload dict via the JSONB codec): skip re-validation
+    return TodoPublic.model_construct(**new_todo_record)
 
 @app.get("/api/todos", response_model=List[TodoPublic])
 async def get_todos(
@@ -294,7 +427,7 @@ async def get_todos(
     desc_search: Optional[str] = None, # description search term (pg_trgm)
     payload_search: Optional[str] = None # payload search term (FTS)
 ):
-    query = "SELECT * FROM todos WHERE user_id = $1"
+    query = f"SELECT {TODO_COLUMNS} FROM todos WHERE user_id = $1"
     params = [current_user.id]
     
     # Search for description using pg_trgm (ILIKE)
@@ -305,7 +438,7 @@ async def get_todos(
     # (Option 1) When searching for an exact word match
     # # Search for payload using FTS (@@)
     # if payload_search:
-    #     query += f" AND to_tsvector('simple', payload::text) @@ websearch_to_tsquery('simple', ${len(params) + 1})"
+    #     query += f" AND payload_tsv @@ websearch_to_tsquery('simple', ${len(params) + 1})"
     #     params.append(payload_search.strip())
         
     # (Option 2) When searching for a partial word match
@@ -314,7 +447,7 @@ async def get_todos(
         ts_index = len(params) + 1
         like_index = ts_index + 1
         query += f""" AND (
-            to_tsvector('simple', payload::text) @@ websearch_to_tsquery('simple', ${ts_index})
+            payload_tsv @@ websearch_to_tsquery('simple', ${ts_index})
             OR EXISTS (SELECT 1 FROM jsonb_array_elements_text(payload->'tags') AS v WHERE v ILIKE ${like_index})
             OR payload->>'priority' ILIKE ${like_index}
             OR EXISTS (SELECT 1 FROM jsonb_array_elements_text(payload->'attachments') AS v WHERE v ILIKE ${like_index})
@@ -325,23 +458,31 @@ async def get_todos(
 
     query += " ORDER BY due_date ASC"
 
-    async with db_pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        todo_records = await conn.fetch(query, *params)
-        
-    return [TodoPublic.model_validate(_coerce_todo_record(record)) for record in todo_records] # Pydantic v2
+    # Stream rows as a JSON array from a server-side cursor; response_model is kept for
+    # the OpenAPI schema but not applied (rows are typed by asyncpg, 'completed' coalesced).
+    # Acquire, run the query and fetch the first page before responding so failures
+    # become 5xx instead of a truncated 200.
+    conn = await db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+    transaction = conn.transaction()
+    try:
+        await transaction.start()
+        cursor = await conn.cursor(query, *params)
+        page = await cursor.fetch(TODO_STREAM_PAGE_SIZE)
+    except BaseException:
+        await _close_todo_stream(conn, transaction)
+        raise
+
+    return _PooledStreamingResponse(
+        _stream_todo_records(cursor, page), conn, transaction, media_type="application/json"
+    )
 
 @app.get("/api/todos/{todo_id}", response_model=TodoPublic)
 async def get_todo_by_id(todo_id: int, current_user: UserInDB = Depends(get_current_user)):
-    async with db_pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        todo_record = await conn.fetchrow(
-            "SELECT * FROM todos WHERE id = $1 AND user_id = $2",
-            todo_id, current_user.id
-        )
+    async with db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT) as conn:
+        todo_record = await conn.fetchrow(SQL_SELECT_TODO, todo_id, current_user.id)
     if not todo_record:
         raise HTTPException(status_code=404, detail="Todo not found.")
-    return TodoPublic.model_validate(_coerce_todo_record(todo_record))
+    return TodoPublic.model_construct(**todo_record)
 
 @app.patch("/api/todos/{todo_id}", response_model=TodoPublic)
 async def update_todo(todo_id: int, todo_update: TodoUpdate, current_user: UserInDB = Depends(get_current_user)):
@@ -350,35 +491,26 @@ async def update_todo(todo_id: int, todo_update: TodoUpdate, current_user: UserI
     if not update_data:
         raise HTTPException(status_code=400, detail="No update content.")
 
+    # Pick the precompiled statement for this field subset (no SQL assembly per request)
+    columns, query = _UPDATE_TODO_SQL[frozenset(update_data)]
+
     # Set 'completed_at' when 'completed' status changes
     if 'completed' in update_data:
         update_data['completed_at'] = datetime.now(timezone.utc) if update_data['completed'] else None
 
-    # Convert payload dict to JSON string for JSONB column
-    if 'payload' in update_data and update_data['payload'] is not None:
-        update_data['payload'] = json.dumps(update_data['payload'])
+    params = [todo_id, *(update_data[col] for col in columns), current_user.id]
 
-    set_clauses = [f"{key} = ${i+2}" for i, key in enumerate(update_data.keys())]
-    query = f"UPDATE todos SET {', '.join(set_clauses)} WHERE id = $1 AND user_id = ${len(update_data) + 2} RETURNING *"
-    
-    params = [todo_id] + list(update_data.values()) + [current_user.id]
-
-    async with db_pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
+    async with db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT) as conn:
         updated_record = await conn.fetchrow(query, *params)
 
     if not updated_record:
         raise HTTPException(status_code=404, detail="Todo not found or no permission to update.")
-    return TodoPublic.model_validate(_coerce_todo_record(updated_record))
+    return TodoPublic.model_construct(**updated_record)
 
 @app.delete("/api/todos/{todo_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_todo(todo_id: int, current_user: UserInDB = Depends(get_current_user)):
-    async with db_pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        result = await conn.execute(
-            "DELETE FROM todos WHERE id = $1 AND user_id = $2",
-            todo_id, current_user.id
-        )
+    async with db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT) as conn:
+        result = await conn.execute(SQL_DELETE_TODO, todo_id, current_user.id)
     # Parse the number from "DELETE 1"
     if int(result.split(' ')[1]) == 0:
         raise HTTPException(status_code=404, detail="Todo not found or no permission to delete.")
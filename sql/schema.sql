@@ -54,11 +54,15 @@ CREATE TABLE todos (
     -- The existing description_fts column has been removed.
     description TEXT NOT NULL,
     -- e.g. payload: {"tags": ["design", "planning"], "priority": "high", "attachments": ["report.pdf"], "notes": "Request final review from Manager Yang"}
-    payload JSONB
+    payload JSONB,
+    -- tsvector of payload text, maintained by PostgreSQL so searches don't recompute it per row
+    -- (Uses 'simple' configuration here which handles all languages well)
+    payload_tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', COALESCE(payload::text, ''))) STORED
 );
--- Creates FTS index that converts text inside payload JSONB to tsvector
--- (Uses 'simple' configuration here which handles all languages well)
-CREATE INDEX idx_todos_payload_fts ON todos USING GIN (to_tsvector('simple', payload::text));
+-- FTS index on the stored payload tsvector
+-- Existing databases: ALTER TABLE todos ADD COLUMN payload_tsv ... (as above), then
+-- DROP INDEX idx_todos_payload_fts; CREATE INDEX CONCURRENTLY idx_todos_payload_fts ON todos USING GIN (payload_tsv);
+CREATE INDEX idx_todos_payload_fts ON todos USING GIN (payload_tsv);
 -- Creates a GIN index using pg_trgm on the description column.
 -- This index makes ILIKE or SIMILARITY searches very fast.
 -- ILIKE search: SELECT * FROM todos WHERE description ILIKE '%buy%';
@@ -88,6 +92,11 @@ CREATE TABLE scheduled_reminders (
 CREATE UNIQUE INDEX IF NOT EXISTS uq_todo_id ON scheduled_reminders (todo_id);
 -- Composite index for workers to efficiently find tasks to process.
 CREATE INDEX idx_scheduled_reminders_for_worker ON scheduled_reminders (status, scheduled_for);
+-- Partial index covering only due-able rows: the worker's claim scan stays small
+-- as sent/failed rows accumulate, and is a good bitmap heap scan candidate for
+-- PostgreSQL 18 async I/O. On an existing database create it online with:
+-- CREATE INDEX CONCURRENTLY idx_scheduled_reminders_pending ON todo_app.scheduled_reminders (scheduled_for) WHERE status = 'pending';
+CREATE INDEX idx_scheduled_reminders_pending ON scheduled_reminders (scheduled_for) WHERE status = 'pending';
 -- =================================================================
 -- FUNCTIONS & TRIGGERS
 -- =================================================================
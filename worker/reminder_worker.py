@@ -1,12 +1,13 @@
 import os
 import asyncio
-import json
+import secrets
 import contextlib
 from datetime import datetime, timezone
-from typing import Optional, List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
 import asyncpg
 import httpx
+import orjson
 from dotenv import load_dotenv
 
 
@@ -38,140 +39,165 @@ POLL_INTERVAL_MAX_SECS = float(os.getenv("REMINDER_POLL_INTERVAL_MAX_SECS", "432
 POOL_MIN_SIZE = int(os.getenv("REMINDER_POOL_MIN_SIZE", "1"))
 POOL_MAX_SIZE = int(os.getenv("REMINDER_POOL_MAX_SIZE", "3"))
 POOL_MAX_INACTIVE_LIFETIME = int(os.getenv("REMINDER_POOL_MAX_INACTIVE_LIFETIME", "60"))
+STATEMENT_CACHE_SIZE = int(os.getenv("REMINDER_STATEMENT_CACHE_SIZE", "1024"))  # 0 behind PgBouncer (transaction pooling)
+SLACK_SEND_TIMEOUT_SECS = float(os.getenv("REMINDER_SLACK_SEND_TIMEOUT_SECS", "15"))  # per-reminder cap
+
+
+# -----------------------------
+# SQL (module-level so asyncpg's statement cache reuses the prepared plans)
+# -----------------------------
+# Claims due reminders and returns everything needed to send them in one roundtrip.
+# LEFT JOINs keep a claimed row in the result even if its todo/user vanished,
+# so it can still be finalized instead of lingering in 'processing'.
+_CLAIM_JOBS_TEMPLATE = """
+WITH cte AS (
+    SELECT id
+    FROM scheduled_reminders
+    WHERE status = 'pending'
+      AND scheduled_for <= now()
+      AND (visibility_timeout IS NULL OR visibility_timeout <= now()){candidates}
+    ORDER BY scheduled_for ASC
+    FOR UPDATE SKIP LOCKED
+    LIMIT {limit}
+),
+claimed AS (
+    UPDATE scheduled_reminders s
+    SET status = 'processing',
+        started_at = now(),
+        visibility_timeout = now() + make_interval(secs => $2)
+    FROM cte
+    WHERE s.id = cte.id
+    -- retry_count is nullable in the schema; finalize_jobs needs a number
+    RETURNING s.id, s.todo_id, s.user_id, COALESCE(s.retry_count, 0) AS retry_count
+)
+SELECT c.id AS reminder_id,
+       c.todo_id,
+       c.user_id,
+       c.retry_count,
+       t.description,
+       t.due_date,
+       t.payload,
+       u.slack_channel
+FROM claimed c
+LEFT JOIN todos t ON t.id = c.todo_id
+LEFT JOIN users u ON u.id = c.user_id;
+"""
+# Slow path: scan for due reminders ($1 = batch size)
+SQL_CLAIM_JOBS = _CLAIM_JOBS_TEMPLATE.format(candidates="", limit="$1")
+# Fast path: claim only the ids delivered by NOTIFY ($1 = id array)
+SQL_CLAIM_JOBS_BY_ID = _CLAIM_JOBS_TEMPLATE.format(
+    candidates="\n      AND id = ANY($1::int[])",
+    limit="cardinality($1::int[])",
+)
+
+# Batch finalizers: one statement per outcome, whatever the batch size
+SQL_MARK_SENT = """
+UPDATE scheduled_reminders
+SET status = 'sent', posted_at = now(), visibility_timeout = NULL, error = NULL
+WHERE id = ANY($1::int[])
+"""
+
+# NACK: bump retry_count and let PostgreSQL decide atomically between a terminal
+# 'failed' and a 'pending' requeue after v.delay seconds ($4 = MAX_RETRIES)
+SQL_NACK = """
+UPDATE scheduled_reminders s
+SET retry_count = COALESCE(s.retry_count, 0) + 1,
+    status = CASE WHEN COALESCE(s.retry_count, 0) + 1 >= $4
+                  THEN 'failed'::reminder_status
+                  ELSE 'pending'::reminder_status END,
+    scheduled_for = CASE WHEN COALESCE(s.retry_count, 0) + 1 >= $4
+                         THEN s.scheduled_for
+                         ELSE now() + make_interval(secs => v.delay) END,
+    started_at = CASE WHEN COALESCE(s.retry_count, 0) + 1 >= $4 THEN s.started_at ELSE NULL END,
+    visibility_timeout = NULL,
+    posted_at = NULL,
+    error = left(v.err, 512)
+FROM unnest($1::int[], $2::int[], $3::text[]) AS v(id, delay, err)
+WHERE s.id = v.id
+"""
 
 
 def _seconds_backoff(retry_count: int) -> int:
-    # Exponential backoff: base * 2^retry_count with a cap
-    secs = BACKOFF_BASE_SECS * (2 ** retry_count)
-    return min(secs, BACKOFF_MAX_SECS)
+    # Exponential backoff with jitter: base + rand[0, base * 2^retry_count), capped.
+    # Jitter spreads retries out so a Slack outage doesn't end in a synchronized burst.
+    return min(BACKOFF_MAX_SECS, BACKOFF_BASE_SECS + secrets.randbelow(max(1, BACKOFF_BASE_SECS << retry_count)))
 
 
 async def create_pool() -> asyncpg.Pool:
     async def _init_connection(conn: asyncpg.Connection) -> None:
-        await conn.execute("SET search_path TO todo_app, public")
+        # Decode JSONB payloads straight to dicts via orjson
+        await conn.set_type_codec(
+            "jsonb",
+            encoder=lambda value: orjson.dumps(value).decode(),
+            decoder=orjson.loads,
+            schema="pg_catalog",
+            format="text",
+        )
+    # search_path is sent in the startup packet: no extra roundtrip per connection
     return await asyncpg.create_pool(
         DATABASE_URL,
         init=_init_connection,
+        server_settings={"search_path": "todo_app, public"},
         min_size=POOL_MIN_SIZE,
         max_size=POOL_MAX_SIZE,
         max_inactive_connection_lifetime=POOL_MAX_INACTIVE_LIFETIME,
+        statement_cache_size=STATEMENT_CACHE_SIZE,
     )
 
 
-async def claim_jobs(pool: asyncpg.Pool, limit: int) -> List[asyncpg.Record]:
-    query = """
-    WITH cte AS (
-        SELECT id
-        FROM scheduled_reminders
-        WHERE status = 'pending'
-          AND scheduled_for <= now()
-          AND (visibility_timeout IS NULL OR visibility_timeout <= now())
-        ORDER BY scheduled_for ASC
-        FOR UPDATE SKIP LOCKED
-        LIMIT $1
-    )
-    UPDATE scheduled_reminders s
-    SET status = 'processing',
-        started_at = now(),
-        visibility_timeout = now() + make_interval(secs => $2)
-    FROM cte
-    WHERE s.id = cte.id
-    RETURNING s.id, s.todo_id, s.user_id;
-    """
-    async with pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        rows = await conn.fetch(query, limit, VISIBILITY_TIMEOUT_SECS)
-    return rows
-
-
-async def fetch_job_details(pool: asyncpg.Pool, reminder_id: int) -> Optional[Dict[str, Any]]:
-    query = """
-    SELECT s.id AS reminder_id,
-           t.id AS todo_id,
-           t.description,
-           t.due_date,
-           t.payload,
-           u.id AS user_id,
-           u.slack_channel
-    FROM scheduled_reminders s
-    JOIN todos t ON t.id = s.todo_id
-    JOIN users u ON u.id = s.user_id
-    WHERE s.id = $1
-    """
+async def claim_jobs(pool: asyncpg.Pool, limit: int) -> List[Dict[str, Any]]:
     async with pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        rec = await conn.fetchrow(query, reminder_id)
-    if rec is None:
-        return None
-    payload = rec["payload"]
-    if isinstance(payload, str):
-        try:
-            payload = json.loads(payload)
-        except Exception:
-            payload = None
-    return {
-        "reminder_id": rec["reminder_id"],
-        "todo_id": rec["todo_id"],
-        "description": rec["description"],
-        "due_date": rec["due_date"],
-        "payload": payload,
-        "user_id": rec["user_id"],
-        "slack_channel": rec["slack_channel"],
-    }
+        rows = await conn.fetch(SQL_CLAIM_JOBS, limit, VISIBILITY_TIMEOUT_SECS)
+    return [dict(rec) for rec in rows]
 
 
-async def mark_sent(pool: asyncpg.Pool, reminder_id: int) -> None:
-    query = """
-    UPDATE scheduled_reminders
-    SET status = 'sent', posted_at = now(), visibility_timeout = NULL, error = NULL
-    WHERE id = $1
-    """
-    async with pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        await conn.execute(query, reminder_id)
-
-
-async def requeue_with_backoff(pool: asyncpg.Pool, reminder_id: int, current_retry: int, error_msg: str) -> None:
-    next_retry = current_retry + 1
-    if next_retry >= MAX_RETRIES:
-        query = """
-        UPDATE scheduled_reminders
-        SET status = 'failed',
-            retry_count = retry_count + 1,
-            visibility_timeout = NULL,
-            posted_at = NULL,
-            error = left($2, 512)
-        WHERE id = $1
-        """
-        async with pool.acquire() as conn:
-            await conn.execute("SET search_path TO todo_app, public")
-            await conn.execute(query, reminder_id, error_msg)
-        return
-
-    delay_secs = _seconds_backoff(next_retry)
-    query = """
-    UPDATE scheduled_reminders
-    SET status = 'pending',
-        retry_count = retry_count + 1,
-        visibility_timeout = NULL,
-        scheduled_for = now() + make_interval(secs => $2),
-        started_at = NULL,
-        error = left($3, 512)
-    WHERE id = $1
-    """
+async def claim_jobs_by_id(pool: asyncpg.Pool, reminder_ids: List[int]) -> List[Dict[str, Any]]:
     async with pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        await conn.execute(query, reminder_id, delay_secs, error_msg)
+        rows = await conn.fetch(SQL_CLAIM_JOBS_BY_ID, reminder_ids, VISIBILITY_TIMEOUT_SECS)
+    return [dict(rec) for rec in rows]
+
+
+def _drain_ids(id_queue: "asyncio.Queue[int]", limit: int) -> List[int]:
+    ids: List[int] = []
+    while len(ids) < limit and not id_queue.empty():
+        ids.append(id_queue.get_nowait())
+    return ids
 
 
-async def get_retry_count(pool: asyncpg.Pool, reminder_id: int) -> int:
+async def finalize_jobs(
+    pool: asyncpg.Pool,
+    sent_ids: List[int],
+    failures: List[Tuple[int, int, str]],
+) -> None:
+    """ACK sent reminders and NACK failures (reminder_id, retry_count, error) on one connection."""
     async with pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        val = await conn.fetchval("SELECT retry_count FROM scheduled_reminders WHERE id = $1", reminder_id)
-        return int(val or 0)
+        if sent_ids:
+            await conn.execute(SQL_MARK_SENT, sent_ids)
+        if failures:
+            await conn.execute(
+                SQL_NACK,
+                [reminder_id for reminder_id, _, _ in failures],
+                [_seconds_backoff(retry_count + 1) for _, retry_count, _ in failures],
+                [error_msg for _, _, error_msg in failures],
+                MAX_RETRIES,
+            )
+
+
+def create_http_client() -> httpx.AsyncClient:
+    # One client for the worker's lifetime so TCP/TLS connections are reused;
+    # HTTP/2 multiplexes concurrent posts to slack.com over a single connection.
+    return httpx.AsyncClient(
+        timeout=10.0,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=64,
+            max_keepalive_connections=32,
+            keepalive_expiry=300,
+        ),
+    )
 
 
-async def post_to_slack(channel: str, text: str) -> None:
+async def post_to_slack(http: httpx.AsyncClient, channel: str, text: str) -> None:
     if not SLACK_BOT_TOKEN:
         raise RuntimeError("SLACK_BOT_TOKEN is not configured")
     headers = {
@@ -179,11 +205,10 @@ async def post_to_slack(channel: str, text: str) -> None:
         "Content-Type": "application/json; charset=utf-8",
     }
     payload = {"channel": channel, "text": text}
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.post(f"{SLACK_API_BASE}/chat.postMessage", headers=headers, json=payload)
-        data = resp.json()
-        if not data.get("ok"):
-            raise RuntimeError(f"Slack API error: {data}")
+    resp = await http.post(f"{SLACK_API_BASE}/chat.postMessage", headers=headers, json=payload)
+    data = resp.json()
+    if not data.get("ok"):
+        raise RuntimeError(f"Slack API error: {data}")
 
 
 def _format_message(job: Dict[str, Any]) -> str:
@@ -210,44 +235,60 @@ def _format_message(job: Dict[str, Any]) -> str:
     return "\n".join(lines)
 
 
-async def process_batch(pool: asyncpg.Pool) -> int:
-    claimed = await claim_jobs(pool, MAX_BATCH)
+async def send_job(http: httpx.AsyncClient, job: Dict[str, Any]) -> None:
+    if job["description"] is None:
+        # Nothing to send; fail it to avoid spinning
+        raise RuntimeError("Missing job details")
+    channel = job["slack_channel"]
+    if not channel:
+        raise RuntimeError("Missing slack_channel")
+    await post_to_slack(http, channel, _format_message(job))
+
+
+async def process_batch(pool: asyncpg.Pool, http: httpx.AsyncClient, id_queue: "asyncio.Queue[int]") -> int:
+    # Event-driven fast path: claim the ids NOTIFY handed us; scan only when none are usable
+    claimed: List[Dict[str, Any]] = []
+    reminder_ids = _drain_ids(id_queue, MAX_BATCH)
+    if reminder_ids:
+        claimed = await claim_jobs_by_id(pool, reminder_ids)
+    if not claimed:
+        claimed = await claim_jobs(pool, MAX_BATCH)
     if not claimed:
         return 0
 
-    for row in claimed:
-        reminder_id = row["id"]
-        try:
-            details = await fetch_job_details(pool, reminder_id)
-            if not details:
-                # Nothing to send; mark failed to avoid spinning
-                await requeue_with_backoff(pool, reminder_id, await get_retry_count(pool, reminder_id), "Missing job details")
-                continue
-            channel = details["slack_channel"]
-            if not channel:
-                await requeue_with_backoff(pool, reminder_id, await get_retry_count(pool, reminder_id), "Missing slack_channel")
-                continue
+    # Post the whole batch concurrently: wallclock is the slowest post, not the sum
+    results = await asyncio.gather(
+        *(asyncio.wait_for(send_job(http, job), SLACK_SEND_TIMEOUT_SECS) for job in claimed),
+        return_exceptions=True,
+    )
 
-            text = _format_message(details)
-            await post_to_slack(channel, text)
-            await mark_sent(pool, reminder_id)
-        except Exception as exc:  # robust handling
-            try:
-                current_retry = await get_retry_count(pool, reminder_id)
-                await requeue_with_backoff(pool, reminder_id, current_retry, str(exc))
-            except Exception:
-                # As a last resort: swallow to keep worker alive
-                pass
+    sent_ids: List[int] = []
+    failures: List[Tuple[int, int, str]] = []
+    for job, result in zip(claimed, results):
+        if isinstance(result, Exception):
+            failures.append((job["reminder_id"], job["retry_count"], str(result) or type(result).__name__))
+        else:
+            sent_ids.append(job["reminder_id"])
+
+    try:
+        await finalize_jobs(pool, sent_ids, failures)
+    except Exception as exc:
+        # As a last resort: log and swallow to keep worker alive
+        print(f"Failed to finalize batch: {exc}", flush=True)
     return len(claimed)
 
 
-async def listen_notifications(pool: asyncpg.Pool, wake_event: asyncio.Event) -> None:
+async def listen_notifications(
+    pool: asyncpg.Pool, wake_event: asyncio.Event, id_queue: "asyncio.Queue[int]"
+) -> None:
     # Dedicated connection for LISTEN/NOTIFY
     conn: asyncpg.Connection
     async with pool.acquire() as conn:
-        await conn.execute("SET search_path TO todo_app, public")
-        def _cb(*_):
-            print("NOTIFY reminder_pending received")
+        def _cb(_conn, _pid, _channel, payload):
+            print(f"NOTIFY reminder_pending received: {payload}")
+            # The trigger sends the reminder id; manual triggers may send any text
+            with contextlib.suppress(ValueError):
+                id_queue.put_nowait(int(payload))
             wake_event.set()
         await conn.add_listener("reminder_pending", _cb)
         try:
@@ -271,10 +312,12 @@ async def main() -> None:
                 delay = min(delay * 2, 30)
 
     pool = await _create_pool_with_retry()
+    http = create_http_client()
     wake_event = asyncio.Event()
+    id_queue: "asyncio.Queue[int]" = asyncio.Queue()
 
     # Start listener task
-    listener_task = asyncio.create_task(listen_notifications(pool, wake_event))
+    listener_task = asyncio.create_task(listen_notifications(pool, wake_event, id_queue))
     print("Reminder worker started. Waiting for jobs…")
 
     # Adaptive polling variables
@@ -284,9 +327,10 @@ async def main() -> None:
 
     try:
         while True:
-            # Process immediately if notified; otherwise poll periodically
+            # Process immediately if notified or ids are queued; otherwise poll periodically
             try:
-                await asyncio.wait_for(wake_event.wait(), timeout=current_poll_interval)
+                if id_queue.empty():
+                    await asyncio.wait_for(wake_event.wait(), timeout=current_poll_interval)
                 wake_event.clear()
                 # When event occurs, reset poll interval to minimum
                 consecutive_empty_batches = 0
@@ -295,7 +339,7 @@ async def main() -> None:
             except asyncio.TimeoutError:
                 pass
 
-            processed = await process_batch(pool)
+            processed = await process_batch(pool, http, id_queue)
             
             # Adaptive polling interval adjustment
             if processed == 0:
@@ -323,6 +367,7 @@ async def main() -> None:
         listener_task.cancel()
         with contextlib.suppress(Exception):
             await listener_task
+        await http.aclose()
         await pool.close()
 
 